@@ -7,8 +7,8 @@ from fastapi.responses import JSONResponse
 from services.meta import send_meta_whatsapp_message, send_manka_menu_template, send_quick_reply_message 
 from services.supabase import store_session_data, get_session_phone_by_id 
 
+# Shares the "whatsapp_app" logger; its level comes from LOG_LEVEL in main.py
 logger = logging.getLogger("whatsapp_app")
-logger.setLevel(logging.DEBUG)
 
 
 def calculate_loan(principal: float, duration: int, rate: float):
@@ -49,13 +49,13 @@ def calculate_loan_results(user_data: dict):
     rate = float(user_data.get("rate", 0))
     from_number = str(user_data.get("from_number") or "") 
     
-    logger.critical(f"✅ Executing Loan Calculation: P={principal}, D={duration}, R={rate} user: {from_number}")
+    logger.critical("✅ Executing Loan Calculation: P=%s, D=%s, R=%s user: %s", principal, duration, rate, from_number)
 
     # Perform Calculation
     try:
         monthly_payment, total_payment, total_interest = calculate_loan(principal, duration, rate)
     except ValueError as e:
-        logger.error(f"❌ Calculation failed due to bad input: {e}")
+        logger.error("❌ Calculation failed due to bad input: %s", e)
         return {"screen": "MAIN_MENU", "data": {"error": "Invalid input"}}
 
     # Format and Return Flow Response (for the Flow UI)
@@ -71,7 +71,7 @@ def calculate_loan_results(user_data: dict):
         }
     }
     
-    logger.critical(f"Flow routing answer: {response_screen} ➡️ Calculation Complete. Ready to route to LOAN_RESULT.")
+    logger.critical("Flow routing answer: %s ➡️ Calculation Complete. Ready to route to LOAN_RESULT.", response_screen)
     return response_screen
 
 async def whatsapp_menu(
@@ -93,7 +93,7 @@ async def whatsapp_menu(
     if not from_number.startswith("+"):
         from_number = "+" + from_number
     
-    logger.critical(f"📱 whatsapp_menu called for: {from_number} with text: {user_text}")
+    logger.critical("📱 whatsapp_menu called for: %s with text: %s", from_number, user_text)
     
     
     # ========================================================================
@@ -107,12 +107,12 @@ async def whatsapp_menu(
     initiation_keywords = ["MENU", "MAMBO", "HI", "HELLO", "ANZA", "MWANZO", "HOLA", "START", "HEY","NIAMBIE","SALAM"]
     
     if user_text_normalized in initiation_keywords:
-        logger.critical(f"🎯 Initiation keyword detected: {user_text_normalized}")
+        logger.critical("🎯 Initiation keyword detected: %s", user_text_normalized)
         
         try:
             # 1. GENERATE UNIQUE FLOW TOKEN (UUID)
             new_flow_token = str(uuid.uuid4())
-            logger.critical(f"🆕 Generated new flow_token (UUID): {new_flow_token}")
+            logger.critical("🆕 Generated new flow_token (UUID): %s", new_flow_token)
 
             # 2. STORE PHONE NUMBER AGAINST THIS UUID (The dot connection)
             # Assuming store_session_data is defined as an async function
@@ -121,16 +121,16 @@ async def whatsapp_menu(
                 message=user_text, 
                 session_id=new_flow_token
             )
-            logger.critical(f"💾 Phone stored against UUID/token: {session_id}")
+            logger.critical("💾 Phone stored against UUID/token: %s", session_id)
             
             # 3. SEND MENU TEMPLATE, EMBEDDING THE UUID
             # CRITICAL: send_manka_menu_template must be async and imported/defined
             await send_manka_menu_template(to=from_number, flow_token=new_flow_token)
             
-            logger.critical(f"✅ Menu template sent to {from_number}, token embedded.")
+            logger.critical("✅ Menu template sent to %s, token embedded.", from_number)
             
         except Exception as e:
-            logger.error(f"❌ Error processing initiation: {e}")
+            logger.error("❌ Error processing initiation: %s", e)
             await send_meta_whatsapp_message(
                 from_number,
                 "Samahani, tatizo limetokea. Tafadhali jaribu tena."
@@ -138,7 +138,7 @@ async def whatsapp_menu(
     
     # Handle unrecognized text
     else:
-        logger.critical(f"⚠️ Unrecognized text message: {user_text}")
+        logger.critical("⚠️ Unrecognized text message: %s", user_text)
         
         await send_meta_whatsapp_message(
             from_number,
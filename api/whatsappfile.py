@@ -1,12 +1,15 @@
+import asyncio
 import logging
 import mimetypes
-import requests
+import httpx
 import uuid
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from services.supabase import store_file
 from services.gemini import analyze_image
 from services.pdfendpoint import analyze_pdf
-from services.meta import send_meta_whatsapp_message
+from services.meta import send_meta_whatsapp_message, HTTP_CLIENT
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -14,9 +17,32 @@ logger = logging.getLogger(__name__)
 
 ALLOWED_IMAGE_TYPES = ["image/jpeg", "image/jpg", "image/png", "image/webp"]
 ALLOWED_PDF_TYPE = "application/pdf"
+UNSUPPORTED_FILE_MESSAGE = "Unsupported file type ({mime_type}). Please send PDF or image (JPG/PNG/WEBP)."
+
+
+def is_supported_file_type(mime_type: str) -> bool:
+    """
+    True for the MIME types process_file_upload can analyze (PDF and common images).
+    """
+    return mime_type == ALLOWED_PDF_TYPE or mime_type in ALLOWED_IMAGE_TYPES
 
 META_ACCESS_TOKEN = os.getenv("META_ACCESS_TOKEN")
 
+# Manka/Gemini analysis and the Supabase upload are blocking calls; run them on a
+# bounded pool so they never stall the event loop or grow past this many threads.
+ANALYSIS_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("ANALYSIS_WORKERS", "4")),
+    thread_name_prefix="file-analysis",
+)
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Run a blocking function on ANALYSIS_EXECUTOR and await its result.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(ANALYSIS_EXECUTOR, partial(func, *args, **kwargs))
+
 
 async def process_file_upload(
     user_id: str,
@@ -25,10 +51,11 @@ async def process_file_upload(
     flow_type: str,
     media_url: str,
     mime_type: str,
-    file_name: str = None
+    file_name: str = None,
+    send_receipt: bool = True
 ):
     try:
-        logger.info(f"Processing file upload: MIME={mime_type}, URL={media_url}")
+        logger.info("Processing file upload: MIME=%s, URL=%s", mime_type, media_url)
 
         if not META_ACCESS_TOKEN:
             error_msg = "Meta Access Token not set. Cannot download media."
@@ -37,7 +64,7 @@ async def process_file_upload(
             return {"status": "error", "message": error_msg}
 
         # Download file from Meta
-        response = requests.get(media_url, headers={"Authorization": f"Bearer {META_ACCESS_TOKEN}"})
+        response = await HTTP_CLIENT.get(media_url, headers={"Authorization": f"Bearer {META_ACCESS_TOKEN}"})
         response.raise_for_status()
         file_data = response.content
 
@@ -46,15 +73,16 @@ async def process_file_upload(
         if not file_name:
             file_name = f"{user_id}_{uuid.uuid4()}{ext}"
 
-        # Inform user that file is received
-        await send_meta_whatsapp_message(user_phone, "Faili yako imepokelewa, tafadhali subiri uchambuzi.")
+        # Inform user that file is received (skipped when the caller already acknowledged it)
+        if send_receipt:
+            await send_meta_whatsapp_message(user_phone, "Faili yako imepokelewa, tafadhali subiri uchambuzi.")
 
         analysis_summary = None
 
         # PDF Analysis
         if mime_type == ALLOWED_PDF_TYPE:
             logger.info("Starting PDF analysis...")
-            result = analyze_pdf(file_data, file_name, user_name)
+            result = await run_blocking(analyze_pdf, file_data, file_name, user_name)
             # If Manka fails, fallback handled inside analyze_pdf
             if isinstance(result, dict):
                 summary = result.get("summary", "")
@@ -71,19 +99,20 @@ async def process_file_upload(
         # Image Analysis
         elif mime_type in ALLOWED_IMAGE_TYPES:
             logger.info("Starting image analysis...")
-            result = analyze_image(file_data, mime_type)
+            result = await run_blocking(analyze_image, file_data, mime_type)
             summary = result.get("summary") if isinstance(result, dict) else str(result)
             analysis_summary = f"🖼️ *Image Analysis Complete*\n\n{summary}"
 
         # Unsupported MIME
         else:
-            message = f"Unsupported file type ({mime_type}). Please send PDF or image (JPG/PNG/WEBP)."
+            message = UNSUPPORTED_FILE_MESSAGE.format(mime_type=mime_type)
             await send_meta_whatsapp_message(user_phone, message)
             return {"status": "unsupported", "message": message}
 
         # Store file in Supabase
         logger.info("Storing file in Supabase...")
-        stored_result = store_file(
+        stored_result = await run_blocking(
+            store_file,
             user_id=user_id,
             user_name=user_name,
             user_phone=user_phone,
@@ -97,7 +126,7 @@ async def process_file_upload(
             raise Exception("Failed to store file or retrieve public URL.")
 
         stored_url = stored_result['file_url']
-        logger.info(f"File stored successfully at {stored_url}")
+        logger.info("File stored successfully at %s", stored_url)
 
         # Send final analysis message if exists
         if analysis_summary:
@@ -105,13 +134,13 @@ async def process_file_upload(
 
         return {"status": "success", "summary": analysis_summary, "file_url": stored_url}
 
-    except requests.exceptions.HTTPError as he:
+    except httpx.HTTPStatusError as he:
         error_msg = f"HTTP error downloading file (status {he.response.status_code})"
         logger.exception(error_msg)
         await send_meta_whatsapp_message(user_phone, "Kumekuwa na shida kupakua faili yako. Tafadhali jaribu tena.")
         return {"status": "error", "message": error_msg}
 
     except Exception as e:
-        logger.exception(f"Error processing file: {e}")
+        logger.exception("Error processing file: %s", e)
         await send_meta_whatsapp_message(user_phone, f" Tatizo lilitokea wakati wa uchambuzi wa faili yako:")
         return {"status": "error", "message": str(e)}
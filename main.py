@@ -1,11 +1,17 @@
 import os
-import json
-import base64
+import hmac
+import asyncio
+import functools
+import binascii
 import logging
-import httpx
-from fastapi import FastAPI, Request, BackgroundTasks
-from fastapi.responses import PlainTextResponse
+import orjson
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse, Response
+from fastapi.middleware.gzip import GZipMiddleware
 from starlette.responses import JSONResponse
+from types import MappingProxyType
+from collections.abc import Mapping
 from typing import Optional
 from dotenv import load_dotenv
 
@@ -13,22 +19,70 @@ load_dotenv()
 
 # Import cryptography libraries
 try:
-    from Crypto.PublicKey import RSA
-    from Crypto.Hash import SHA256
-    from Crypto.Cipher import PKCS1_OAEP, AES
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 except ImportError:
-    raise RuntimeError("PyCryptodome is not installed. Please install with: pip install pycryptodome")
+    raise RuntimeError("cryptography is not installed. Please install with: pip install cryptography")
 
 # Import WhatsApp handling functions
 from api.whatsappBOT import whatsapp_menu, calculate_loan_results
-from api.whatsappfile import process_file_upload
-from services.meta import send_meta_whatsapp_message, get_media_url, send_manka_menu_template
+from api.whatsappfile import process_file_upload, is_supported_file_type, UNSUPPORTED_FILE_MESSAGE
+from services.meta import send_meta_whatsapp_message, get_media_url, send_manka_menu_template, HTTP_CLIENT, close_http_client
 
-# Setup logging
+# Setup logging (LOG_LEVEL=DEBUG turns on the decrypted flow dump)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 logger = logging.getLogger("whatsapp_app")
-logger.setLevel(logging.DEBUG)
+logger.setLevel(LOG_LEVEL)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Start the media workers (and the optional crypto warm-up) on boot; on shutdown stop
+    the workers, then close the shared Meta HTTP client.
+    """
+    start_media_workers(app)
+    await warm_up_flow_crypto_if_enabled()
+    try:
+        yield
+    finally:
+        await stop_media_workers(app)
+        await close_http_client()
+
+
+app = FastAPI(lifespan=lifespan)
+# Only applies when the caller sends Accept-Encoding: gzip; short "OK" acks stay uncompressed
+app.add_middleware(GZipMiddleware, minimum_size=512, compresslevel=4)
+
+# Upper bound for a webhook body. Defaults to Meta's documented 3 MB webhook payload limit:
+# batched notifications can be large, and a 413 makes Meta retry and eventually drop them.
+# Set MAX_WEBHOOK_BODY_BYTES lower (e.g. 65536) only if your traffic is known to fit.
+MAX_WEBHOOK_BODY_BYTES = int(os.getenv("MAX_WEBHOOK_BODY_BYTES", str(3 * 1024 * 1024)))
+
+
+async def read_body_limited(request: Request, limit: int = MAX_WEBHOOK_BODY_BYTES) -> Optional[bytes]:
+    """
+    Stream the request body into one buffer, giving up (None) as soon as it exceeds `limit`.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > limit:
+        return None
+
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > limit:
+            return None
+    return bytes(body)
+
+# The handler takes no BackgroundTasks, so FastAPI never attaches per-request state to
+# a returned Response; the plain "OK" acknowledgement can be one shared instance.
+OK_RESPONSE = Response(content=b"OK", media_type="text/plain")
+
+# Key that only encrypted flow envelopes carry
+_FLOW_PAYLOAD_MARKER = b'"encrypted_flow_data"'
 
 # --------------------------------------------------
 # CTA URL MESSAGE
@@ -62,23 +116,116 @@ async def send_cta_url_message(to_phone: str, body_text: str, button_label: str,
         }
     }
 
-    async with httpx.AsyncClient() as client:
-        await client.post(url, json=payload, headers=headers)
+    await HTTP_CLIENT.post(url, json=payload, headers=headers)
+
+
+# --------------------------------------------------
+# BACKGROUND TASKS
+# --------------------------------------------------
+# Fire-and-forget replies run as plain asyncio tasks on the event loop. The set keeps a
+# strong reference to each task until it finishes so it cannot be garbage collected early.
+_BACKGROUND_TASKS = set()
+
+
+def _on_background_task_done(task: asyncio.Task):
+    _BACKGROUND_TASKS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("❌ Background task failed: %s", task.exception(), exc_info=task.exception())
+
+
+def spawn_background_task(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_on_background_task_done)
+    return task
+
+
+# --------------------------------------------------
+# MEDIA WORKER POOL
+# --------------------------------------------------
+# Media jobs go through a bounded queue drained by a fixed set of workers, so bursts of
+# uploads get backpressure instead of piling up as per-request background tasks.
+MEDIA_WORKER_COUNT = int(os.getenv("MEDIA_WORKER_COUNT", "4"))
+MEDIA_QUEUE_MAXSIZE = int(os.getenv("MEDIA_QUEUE_MAXSIZE", "1000"))
+
+
+async def process_media_job(from_number: str, user_name: str, media_id: str, mime_type: str, file_name: str):
+    """
+    Resolve the media URL, acknowledge receipt and run the file analysis for one media message.
+    """
+    # Unsupported files get a single reply: no ack, no media URL lookup, no download
+    if not is_supported_file_type(mime_type):
+        await send_meta_whatsapp_message(from_number, UNSUPPORTED_FILE_MESSAGE.format(mime_type=mime_type))
+        return
+
+    try:
+        # Ack only once the media URL resolved, so a failed lookup sends just the error reply
+        media_url = await get_media_url(media_id)
+        await send_meta_whatsapp_message(from_number, "✅ Tumepokea faili lako. Tafadhali subiri uchambuzi wa kwanza...")
+
+        await process_file_upload(
+            user_id=from_number,
+            user_name=user_name,
+            user_phone=from_number,
+            flow_type="REGULAR_MEDIA",
+            media_url=media_url,
+            mime_type=mime_type,
+            file_name=file_name,
+            send_receipt=False  # already acknowledged above, one status message per file
+        )
+
+    except Exception as e:
+        logger.error("❌ Error handling media ID %s: %s", media_id, e, exc_info=True)
+        await send_meta_whatsapp_message(from_number, "Samahani, kuna hitilafu imetokea wakati tukipakia faili lako.")
+
+
+async def media_worker(queue: asyncio.Queue):
+    while True:
+        job = await queue.get()
+        try:
+            await process_media_job(**job)
+        except Exception as e:
+            logger.error("❌ Media worker failed on job for %s: %s", job.get('from_number'), e, exc_info=True)
+        finally:
+            queue.task_done()
+
+
+def start_media_workers(app: FastAPI):
+    app.state.media_queue = asyncio.Queue(maxsize=MEDIA_QUEUE_MAXSIZE)
+    app.state.media_workers = [
+        asyncio.create_task(media_worker(app.state.media_queue))
+        for _ in range(MEDIA_WORKER_COUNT)
+    ]
+
+
+async def stop_media_workers(app: FastAPI):
+    for worker in app.state.media_workers:
+        worker.cancel()
+    await asyncio.gather(*app.state.media_workers, return_exceptions=True)
 
 
 WEBHOOK_VERIFY_TOKEN = os.getenv("WEBHOOK_VERIFY_TOKEN")
+_WEBHOOK_VERIFY_TOKEN_BYTES = WEBHOOK_VERIFY_TOKEN.encode("utf-8") if WEBHOOK_VERIFY_TOKEN else None
 
 @app.get("/whatsapp-webhook/")
 async def verify_webhook(request: Request):
-    params = request.query_params
-    if params.get("hub.mode") == "subscribe" and params.get("hub.verify_token") == WEBHOOK_VERIFY_TOKEN:
+    params = request.query_params  # parsed once, then reused for all three fields
+    token = params.get("hub.verify_token")
+    if (
+        _WEBHOOK_VERIFY_TOKEN_BYTES
+        and token
+        and params.get("hub.mode") == "subscribe"
+        and hmac.compare_digest(token.encode("utf-8"), _WEBHOOK_VERIFY_TOKEN_BYTES)
+    ):
         return PlainTextResponse(params.get("hub.challenge"))
     return PlainTextResponse("Verification failed", status_code=403)
 
 # --------------------------------------------------
-# FLOW DEFINITIONS (UNCHANGED)
+# FLOW DEFINITIONS
 # --------------------------------------------------
-FLOW_DEFINITIONS = {
+FLOW_SUCCESS_TOKEN_PLACEHOLDER = "RETURNED_FLOW_TOKEN"
+
+_FLOW_DEFINITIONS = {
     "LOAN_FLOW_ID_1": {
         "SUCCESS_ACTION": "SUBMIT_LOAN",
         "SUCCESS_RESPONSE": {
@@ -86,7 +233,7 @@ FLOW_DEFINITIONS = {
             "data": {
                 "extension_message_response": {
                     "params": {
-                        "flow_token": "RETURNED_FLOW_TOKEN",
+                        "flow_token": FLOW_SUCCESS_TOKEN_PLACEHOLDER,
                         "loan_summary": "Loan processed"
                     }
                 }
@@ -95,41 +242,379 @@ FLOW_DEFINITIONS = {
     }
 }
 
+# Flow entries (those with a SUCCESS_ACTION) are frozen one level deep so request code cannot
+# swap their actions or screens; every other entry and all screen dicts stay plain for orjson.
+FLOW_DEFINITIONS = MappingProxyType({
+    key: MappingProxyType(entry) if "SUCCESS_ACTION" in entry else entry
+    for key, entry in _FLOW_DEFINITIONS.items()
+})
+
+# SUCCESS_RESPONSE screens are serialized once at import (flow_id -> JSON bytes);
+# only the flow token is spliced in per request.
+_FLOW_TOKEN_PLACEHOLDER_JSON = orjson.dumps(FLOW_SUCCESS_TOKEN_PLACEHOLDER)
+SUCCESS_RESPONSE_TEMPLATES = {
+    flow_id: orjson.dumps(definition["SUCCESS_RESPONSE"])
+    for flow_id, definition in FLOW_DEFINITIONS.items()
+    if isinstance(definition, Mapping) and "SUCCESS_RESPONSE" in definition
+}
+
+
+def render_success_response(flow_id_key: str, flow_token: Optional[str]) -> bytes:
+    """
+    Return the serialized SUCCESS_RESPONSE for a flow with the flow_token filled in.
+    """
+    template = SUCCESS_RESPONSE_TEMPLATES[flow_id_key]
+    if not flow_token:
+        return template
+    return template.replace(_FLOW_TOKEN_PLACEHOLDER_JSON, orjson.dumps(flow_token), 1)
+
+# --------------------------------------------------
+# FLOW ROUTING
+# --------------------------------------------------
+# Every handler takes (flow_id_key, action, current_screen, user_data, flow_token) and
+# returns either a response dict or an already serialized JSON body (bytes).
+
+# Shared responses resolved once at import; Meta's health check expects {"data": {"status": "active"}}.
+# dict() keeps them orjson-serializable even if a definition entry ever arrives frozen.
+PING_RESPONSE = dict(FLOW_DEFINITIONS.get("HEALTH_CHECK_PING", {"data": {"status": "active"}}))
+FLOW_ERROR_RESPONSE = dict(FLOW_DEFINITIONS.get("ERROR", {"screen": "MAIN_MENU", "data": {"error_message": "Hitilafu imetokea. Tunaanza tena."}}))
+
+LOAN_MENU_SCREENS = frozenset({"CREDIT_SCORE", "CREDIT_BANDWIDTH", "LOAN_CALCULATOR", "LOAN_TYPES", "SERVICES", "AFFORDABILITY_CHECK"})
+
+
+def _data_exchange_error(user_data: dict) -> Optional[dict]:
+    if user_data.get("error"):
+        return {"screen": "MAIN_MENU", "data": {"error_message": "Hitilafu imetokea. Tunaanza tena."}}
+    return None
+
+
+def _handle_ping(flow_id_key, action, current_screen, user_data, flow_token):
+    return PING_RESPONSE
+
+
+def _handle_flow_error(flow_id_key, action, current_screen, user_data, flow_token):
+    return FLOW_ERROR_RESPONSE
+
+
+def _handle_unknown_action(flow_id_key, action, current_screen, user_data, flow_token):
+    return {"screen": current_screen, "data": {"error_message": f"Action '{action}' not handled."}}
+
+
+def _handle_flow_success(flow_id_key, action, current_screen, user_data, flow_token):
+    if flow_token:
+        logger.critical("Flow %s finalized.", flow_id_key)
+
+    # ⭐ LOAN FLOW FINALIZATION: REMOVE QUICK REPLY MESSAGE SENDING
+    if flow_id_key == "LOAN_FLOW_ID_1":
+        logger.critical("🛑 LOAN FLOW SUCCESS: Not sending Quick Reply. Results remain in Flow UI.")
+
+    return render_success_response(flow_id_key, flow_token)
+
+
+def _handle_loan_init(flow_id_key, action, current_screen, user_data, flow_token):
+    return {"screen": "MAIN_MENU", "data": user_data}
+
+
+def _screen_with_data(screen: dict, user_data: dict) -> dict:
+    """
+    Build a response from a static screen without mutating it: only the top level
+    and "data" are copied, which is all a handler ever changes.
+    """
+    return {**screen, "data": {**screen["data"], **user_data}}
+
+
+def _handle_account_init(flow_id_key, action, current_screen, user_data, flow_token):
+    return _screen_with_data(FLOW_DEFINITIONS[flow_id_key]["PROFILE"], user_data)
+
+
+def _handle_loan_result(user_data):
+    # Calculate and get Flow UI response (sync)
+    try:
+        return calculate_loan_results(user_data)
+    except (ValueError, Exception) as e:
+        logger.error("❌ Invalid loan parameters or calculation error: %s", e)
+        return {"screen": "LOAN_CALCULATOR", "data": {"error_message": "Tafadhali jaza nambari sahihi."}}
+
+
+# Loan screen transitions with their own logic: (current_screen, next_screen) -> handler(user_data)
+LOAN_SCREEN_ROUTES = {
+    ("LOAN_CALCULATOR", "LOAN_RESULT"): _handle_loan_result,
+}
+
+
+def _handle_loan_data_exchange(flow_id_key, action, current_screen, user_data, flow_token):
+    error_response = _data_exchange_error(user_data)
+    if error_response:
+        return error_response
+
+    next_screen_key = user_data.get("next_screen")
+
+    if next_screen_key and next_screen_key in FLOW_DEFINITIONS[flow_id_key]:
+        screen_handler = LOAN_SCREEN_ROUTES.get((current_screen, next_screen_key))
+        if screen_handler:
+            return screen_handler(user_data)
+        return {"screen": next_screen_key, "data": user_data}
+
+    if current_screen == "MAIN_MENU":
+        next_screen_id = user_data.get("selected_service")
+        if next_screen_id in LOAN_MENU_SCREENS:
+            return {"screen": next_screen_id, "data": user_data}
+        return {"screen": "MAIN_MENU", "data": {"error_message": "Chaguo batili."}}
+
+    return {"screen": "MAIN_MENU", "data": {"error_message": "Kosa: Sehemu ya huduma haikupatikana."}}
+
+
+def _handle_account_data_exchange(flow_id_key, action, current_screen, user_data, flow_token):
+    error_response = _data_exchange_error(user_data)
+    if error_response:
+        return error_response
+
+    if current_screen == "PROFILE_UPDATE":
+        return _screen_with_data(FLOW_DEFINITIONS[flow_id_key]["SUMMARY"], user_data)
+
+    return FLOW_ERROR_RESPONSE
+
+
+def _handle_data_exchange_fallback(flow_id_key, action, current_screen, user_data, flow_token):
+    return _data_exchange_error(user_data) or FLOW_ERROR_RESPONSE
+
+
+# Flow-specific routes, checked first: (flow_id_key, action) -> handler
+FLOW_ROUTES = {
+    ("LOAN_FLOW_ID_1", "INIT"): _handle_loan_init,
+    ("ACCOUNT_FLOW_ID_2", "INIT"): _handle_account_init,
+    ("LOAN_FLOW_ID_1", "data_exchange"): _handle_loan_data_exchange,
+    ("ACCOUNT_FLOW_ID_2", "data_exchange"): _handle_account_data_exchange,
+}
+FLOW_ROUTES.update({
+    (flow_id, definition["SUCCESS_ACTION"]): _handle_flow_success
+    for flow_id, definition in FLOW_DEFINITIONS.items()
+    if isinstance(definition, Mapping) and "SUCCESS_ACTION" in definition
+})
+
+# Action-level fallbacks for flows without a specific route: action -> handler
+ACTION_ROUTES = {
+    "ping": _handle_ping,
+    "INIT": _handle_flow_error,
+    "data_exchange": _handle_data_exchange_fallback,
+}
+
+
+def route_flow_action(flow_id_key: str, action: Optional[str]):
+    """
+    Resolve the handler for a decrypted flow request with one or two dict lookups.
+    """
+    return FLOW_ROUTES.get((flow_id_key, action)) or ACTION_ROUTES.get(action, _handle_unknown_action)
+
 # --------------------------------------------------
 # RSA SETUP
 # --------------------------------------------------
-def load_private_key(key_string: str) -> RSA.RsaKey:
+# The key is loaded on the first flow payload, so worker start-up and text/media
+# webhooks never pay for PEM parsing unless WARM_UP_FLOW_CRYPTO opts in to loading
+# it at startup. RSA-OAEP runs on OpenSSL via cryptography.
+
+# Meta wraps the AES key with RSA-OAEP using SHA-256 for both the digest and MGF1
+OAEP_PADDING = padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
+
+
+def load_private_key(key_string: str) -> rsa.RSAPrivateKey:
     key_string = key_string.replace("\\n", "\n")
-    return RSA.import_key(key_string)
+    # Full RSA validation stays on: the key loads once per process, and it is the only
+    # check that rejects a mangled PRIVATE_KEY before it reaches OpenSSL's decrypt path
+    return serialization.load_pem_private_key(key_string.encode("utf-8"), password=None)
+
+
+# Padded base64 length of a wrapped AES key (exactly one RSA block); known once the key is loaded
+WRAPPED_AES_KEY_B64_LEN: Optional[int] = None
+
+
+@functools.lru_cache(maxsize=None)
+def get_private_key():
+    """
+    Load PRIVATE_KEY once and return (private key, RSA modulus size in bytes).
+    """
+    global WRAPPED_AES_KEY_B64_LEN
+    private_key = load_private_key(os.getenv("PRIVATE_KEY"))
+    rsa_key_bytes = (private_key.key_size + 7) // 8
+    WRAPPED_AES_KEY_B64_LEN = ((rsa_key_bytes + 2) // 3) * 4
+    return private_key, rsa_key_bytes
+
+
+@functools.lru_cache(maxsize=1024)
+def unwrap_aes_key(encrypted_aes_key_bytes: bytes) -> bytes:
+    """
+    RSA-OAEP unwrap of Meta's per-request AES key, cached so retried payloads skip the RSA step.
+    Failed unwraps raise and are never cached.
+    """
+    private_key, rsa_key_bytes = get_private_key()
+    if len(encrypted_aes_key_bytes) != rsa_key_bytes:
+        raise ValueError(f"Encrypted AES key length mismatch. Expected {rsa_key_bytes} bytes.")
+    return private_key.decrypt(encrypted_aes_key_bytes, OAEP_PADDING)
+
+
+@functools.lru_cache(maxsize=256)
+def get_aead(aes_key: bytes) -> AESGCM:
+    """
+    Return an AESGCM context for the session key, reusing it when Meta retries a payload.
+    """
+    return AESGCM(aes_key)
+
+def decrypt_flow_request(encrypted_aes_key_bytes: bytes, iv: bytes, encrypted_flow_bytes: bytes):
+    """
+    Unwrap the AES key and decrypt the flow body; returns (AESGCM context, plaintext bytes).
+    Blocking CPU work, run off the event loop with asyncio.to_thread.
+    """
+    aes_key = unwrap_aes_key(encrypted_aes_key_bytes)
+    # One AESGCM context per session key: it holds the key schedule and serves
+    # both the request decrypt and the response encrypt (only the nonce differs).
+    # Meta appends the 16-byte tag to the ciphertext, which is the layout AESGCM expects.
+    aead = get_aead(aes_key)
+    return aead, aead.decrypt(iv, encrypted_flow_bytes, None)
+
+# Base64 codecs bound once; the flow branch calls them four times per request
+_b64decode = binascii.a2b_base64
+_b64encode = binascii.b2a_base64
+
+# Meta sends a 16-byte IV; the response nonce is the IV with every bit inverted.
+_IV_BYTES = 16
+_IV_XOR_MASK_INT = (1 << (_IV_BYTES * 8)) - 1
+
+
+def flip_iv(iv: bytes) -> bytes:
+    """
+    Invert all bits of the request IV with a single big-int XOR.
+    """
+    size = len(iv)
+    mask = _IV_XOR_MASK_INT if size == _IV_BYTES else (1 << (size * 8)) - 1
+    return (int.from_bytes(iv, "big") ^ mask).to_bytes(size, "big")
+
+
+def warm_up_flow_crypto():
+    """
+    Run one throwaway request through the flow crypto path (key load, RSA-OAEP unwrap,
+    AES-GCM decrypt and response encrypt) so the first real flow request starts warm.
+    """
+    private_key, _ = get_private_key()
+    aes_key = os.urandom(16)
+    iv = os.urandom(_IV_BYTES)
+    wrapped_key = private_key.public_key().encrypt(aes_key, OAEP_PADDING)
+    encrypted_flow = AESGCM(aes_key).encrypt(iv, b'{"action": "ping"}', None)
+    aead, _ = decrypt_flow_request(wrapped_key, iv, encrypted_flow)
+    aead.encrypt(flip_iv(iv), orjson.dumps(PING_RESPONSE), None)
+
+
+async def warm_up_flow_crypto_if_enabled():
+    # Opt-in: trades lazy key loading for a warm first flow request
+    if os.getenv("WARM_UP_FLOW_CRYPTO", "").lower() not in ("1", "true", "yes") or not os.getenv("PRIVATE_KEY"):
+        return
+    try:
+        await asyncio.to_thread(warm_up_flow_crypto)
+        logger.critical("🔥 Flow crypto warmed up.")
+    except Exception as e:
+        logger.critical("🚨 Flow crypto warm-up failed: %s", e)
+
+# --------------------------------------------------
+# REGULAR MESSAGE ROUTING
+# --------------------------------------------------
+# Every handler takes (request, message, message_type, from_number, user_name).
+MEDIA_MESSAGE_TYPES = frozenset({"image", "document", "video", "audio"})
+
+
+async def handle_text_message(request, message, message_type, from_number, user_name):
+    # Create the simplified payload dictionary
+    text_payload = {
+        "from_number": from_number,
+        "user_name": user_name,
+        "body": message.get("text", {}).get("body", "") # The message text
+    }
+    
+    logger.critical("💬 Message from %s (%s): %s", from_number, user_name, text_payload['body'])
+    
+    # Reroute to whatsapp_menu with the text payload dict
+    spawn_background_task(whatsapp_menu(text_payload))
+    logger.critical("✅ Text message '%s' routed to whatsapp_menu for %s.", text_payload['body'], from_number)
+
+
+async def handle_media_message(request, message, message_type, from_number, user_name):
+    media_object = message.get(message_type, {})
+    media_id = media_object.get("id")
+    if not media_id:
+        return
+
+    mime_type = media_object.get("mime_type")
+    file_name = media_object.get("filename", f"file.{mime_type.split('/')[-1] if '/' in mime_type else 'dat'}")
+
+    logger.critical("📎 Media message detected: %s, ID: %s", message_type, media_id)
+    try:
+        request.app.state.media_queue.put_nowait({
+            "from_number": from_number,
+            "user_name": user_name,
+            "media_id": media_id,
+            "mime_type": mime_type,
+            "file_name": file_name,
+        })
+        logger.critical("✅ Media processing task queued for %s", from_number)
+
+    except asyncio.QueueFull:
+        logger.error("❌ Media queue full, rejecting media ID %s from %s", media_id, from_number)
+        await send_meta_whatsapp_message(from_number, "Samahani, tuna msongamano kwa sasa. Tafadhali tuma faili lako tena baada ya muda mfupi.")
+
+
+async def handle_interactive_message(request, message, message_type, from_number, user_name):
+    logger.critical("💬 Received Interactive message from %s", from_number)
+
 
-PRIVATE_KEY = load_private_key(os.getenv("PRIVATE_KEY"))
-RSA_CIPHER = PKCS1_OAEP.new(PRIVATE_KEY, hashAlgo=SHA256)
+async def handle_unhandled_message(request, message, message_type, from_number, user_name):
+    logger.critical("Received unhandled message type: %s from %s", message_type, from_number)
+
+
+MESSAGE_HANDLERS = {
+    "text": handle_text_message,
+    "interactive": handle_interactive_message,
+    **dict.fromkeys(MEDIA_MESSAGE_TYPES, handle_media_message),
+}
 
 # ----------------------------------------------------------------------
 ## 🚀 WEBHOOK HANDLER (POST) - All Flow Routing and Message Handling
 # ----------------------------------------------------------------------
 
 @app.post("/whatsapp-webhook/")
-async def whatsapp_webhook(request: Request, background_tasks: BackgroundTasks):
-    logger.critical(f"🚀 [INIT] Webhook received POST request.")
+async def whatsapp_webhook(request: Request):
+    logger.critical("🚀 [INIT] Webhook received POST request.")
     
     try:
-        raw_body = await request.body()
-        payload = json.loads(raw_body.decode('utf-8'))
+        raw_body = await read_body_limited(request)
+        if raw_body is None:
+            logger.critical("🚨 Webhook body exceeds %s bytes. Rejecting.", MAX_WEBHOOK_BODY_BYTES)
+            return PlainTextResponse("Payload Too Large", status_code=413)
+        # Every webhook Meta sends is a JSON object; skip the parser for empty or non-JSON bodies
+        if raw_body[:1] != b"{":
+            logger.critical("Ignoring webhook body that is not a JSON object.")
+            return OK_RESPONSE
+        payload = orjson.loads(raw_body)
         logger.critical("JSON Parsed Successfully.")
 
+        # Determine if it's a Flow payload; message notifications (most traffic) never carry
+        # the marker, so one substring scan of the raw body skips the three lookups for them
+        is_flow_payload = False
+        if _FLOW_PAYLOAD_MARKER in raw_body:
+            encrypted_flow_b64 = payload.get("encrypted_flow_data")
+            encrypted_aes_key_b64 = payload.get("encrypted_aes_key")
+            iv_b64 = payload.get("initial_vector")
+            is_flow_payload = encrypted_flow_b64 and encrypted_aes_key_b64 and iv_b64
+
         # --- Extract Metadata ---
-        entry = payload.get("entry", [{}])[0]
-        changes = entry.get("changes", [{}])[0]
-        value = changes.get("value", {})
-        messages = value.get("messages", [])
-        contacts = value.get("contacts", [])
-        
-        # Determine if it's a Flow payload
-        encrypted_flow_b64 = payload.get("encrypted_flow_data")
-        encrypted_aes_key_b64 = payload.get("encrypted_aes_key")
-        iv_b64 = payload.get("initial_vector")
-        is_flow_payload = encrypted_flow_b64 and encrypted_aes_key_b64 and iv_b64
+        # Flow envelopes are flat, so only message notifications walk entry -> changes -> value
+        if is_flow_payload:
+            messages = contacts = ()
+        else:
+            # Subscripted walk: no default lists/dicts are built on the happy path
+            try:
+                value = payload["entry"][0]["changes"][0]["value"]
+            except (KeyError, IndexError, TypeError):
+                value = {}
+            messages = value.get("messages", ())
+            contacts = value.get("contacts", ())
         
         # Safely extract primary_from_number from standard locations in the webhook payload
         primary_from_number: Optional[str] = None
@@ -141,139 +626,76 @@ async def whatsapp_webhook(request: Request, background_tasks: BackgroundTasks):
 
         if primary_from_number and not primary_from_number.startswith("+"):
             primary_from_number = "+" + primary_from_number
-        logger.critical(f"📞 Initial Phone Number Detected: {primary_from_number}")
+        logger.critical("📞 Initial Phone Number Detected: %s", primary_from_number)
 
         # ========================================================================
         # ENCRYPTED FLOW PAYLOAD PROCESSING
         # ========================================================================
         if is_flow_payload:
-            # ... (Decryption logic remains UNCHANGED) ...
+            # Reject a malformed wrapped key before any decode work. Until the key has been
+            # loaded (off the loop, by the first flow request) the length is unknown and the
+            # decoded-length check in unwrap_aes_key() covers it.
+            if WRAPPED_AES_KEY_B64_LEN is not None and len(encrypted_aes_key_b64) != WRAPPED_AES_KEY_B64_LEN:
+                logger.error("❌ Rejecting flow payload: encrypted_aes_key is %s base64 chars, expected %s.", len(encrypted_aes_key_b64), WRAPPED_AES_KEY_B64_LEN)
+                return PlainTextResponse("Invalid encrypted_aes_key length.", status_code=400)
+
             try:
-                encrypted_aes_key_bytes = base64.b64decode(encrypted_aes_key_b64)
-                logger.critical(f"🔑 Decrypting AES key size: {len(encrypted_aes_key_bytes)} bytes.")
-                aes_key = RSA_CIPHER.decrypt(encrypted_aes_key_bytes)
-                iv = base64.b64decode(iv_b64)
-                encrypted_flow_bytes = base64.b64decode(encrypted_flow_b64)
-                ciphertext = encrypted_flow_bytes[:-16]
-                tag = encrypted_flow_bytes[-16:]
-                cipher_aes = AES.new(aes_key, AES.MODE_GCM, nonce=iv)
-                decrypted_bytes = cipher_aes.decrypt_and_verify(ciphertext, tag)
-                decrypted_data = json.loads(decrypted_bytes.decode("utf-8"))
-
-                logger.critical(f"📥 Decrypted Flow Data: {json.dumps(decrypted_data, indent=2)}")
+                # Decode all three fields up front with the thin C base64 decoder
+                encrypted_aes_key_bytes = _b64decode(encrypted_aes_key_b64)
+                iv = _b64decode(iv_b64)
+                encrypted_flow_bytes = _b64decode(encrypted_flow_b64)
+
+                logger.critical("🔑 Decrypting AES key size: %s bytes.", len(encrypted_aes_key_bytes))
+                # RSA-OAEP dominates the request's CPU time; OpenSSL releases the GIL, so run it in a thread
+                aead, decrypted_bytes = await asyncio.to_thread(
+                    decrypt_flow_request, encrypted_aes_key_bytes, iv, encrypted_flow_bytes
+                )
+                decrypted_data = orjson.loads(decrypted_bytes)
+
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("📥 Decrypted Flow Data: %s", orjson.dumps(decrypted_data, option=orjson.OPT_INDENT_2).decode())
 
                 action = decrypted_data.get("action")
                 flow_token = decrypted_data.get("flow_token")
                 user_data = decrypted_data.get("data", {})
                 current_screen = decrypted_data.get("screen", "UNKNOWN")
                 flow_id_key = user_data.get("flow_id", "LOAN_FLOW_ID_1") 
-                current_flow_screens = FLOW_DEFINITIONS.get(flow_id_key)
-                response_obj = None
                 
                 best_phone = primary_from_number if primary_from_number else user_data.get("from_number")
                 if best_phone:
                     user_data["from_number"] = best_phone
                     primary_from_number = best_phone
                 
-                # 1. PING RESPONSE (UNCHANGED)
-                if action == "ping":
-                    response_obj = FLOW_DEFINITIONS["HEALTH_CHECK_PING"]
-                
-                # 2. SUCCESS ACTION (FINAL MESSAGE SEND)
-                elif current_flow_screens and action == current_flow_screens.get("SUCCESS_ACTION"):
-                    
-                    response_obj = json.loads(json.dumps(current_flow_screens["SUCCESS_RESPONSE"])) 
-                    if flow_token:
-                        success_params = response_obj["data"]["extension_message_response"]["params"]
-                        success_params["flow_token"] = flow_token
-                        logger.critical(f"Flow {flow_id_key} finalized.")
-                    
-                    # ⭐ LOAN FLOW FINALIZATION: REMOVE QUICK REPLY MESSAGE SENDING
-                    if flow_id_key == "LOAN_FLOW_ID_1":
-                        logger.critical("🛑 LOAN FLOW SUCCESS: Not sending Quick Reply. Results remain in Flow UI.")
-                        
-                    # NOTE: You can add logic here if you want to send a *simple* completion message:
-                    # if primary_from_number:
-                    #     background_tasks.add_task(send_meta_whatsapp_message, primary_from_number, "Asante kwa kutumia kikokotoo cha mkopo!")
-
-
-                # 3. INIT ACTION (UNCHANGED)
-                elif action == "INIT":
-                    if flow_id_key == "LOAN_FLOW_ID_1":
-                        response_obj = {"screen": "MAIN_MENU", "data": user_data} 
-                    elif flow_id_key == "ACCOUNT_FLOW_ID_2":
-                        response_obj = current_flow_screens["PROFILE"]
-                        response_obj["data"].update(user_data) 
-                    else:
-                        response_obj = FLOW_DEFINITIONS["ERROR"]
-                
-                # 4. DATA EXCHANGE ACTION (UNCHANGED)
-                elif action == "data_exchange":
-                    
-                    if user_data.get("error"):
-                        response_obj = {"screen": "MAIN_MENU", "data": {"error_message": "Hitilafu imetokea. Tunaanza tena."}}
-                    
-                    elif flow_id_key == "LOAN_FLOW_ID_1":
-                        next_screen_key = user_data.get("next_screen")
-                        
-                        if next_screen_key and next_screen_key in FLOW_DEFINITIONS[flow_id_key]:
-                            
-                            if next_screen_key == "LOAN_RESULT" and current_screen == "LOAN_CALCULATOR":
-                                # Calculate and get Flow UI response (sync)
-                                try:
-                                    response_obj = calculate_loan_results(user_data)
-                                except (ValueError, Exception) as e:
-                                    logger.error(f"❌ Invalid loan parameters or calculation error: {e}")
-                                    response_obj = {"screen": "LOAN_CALCULATOR", "data": {"error_message": "Tafadhali jaza nambari sahihi."}}
-                            
-                            else:
-                                response_obj = {"screen": next_screen_key, "data": user_data}
-                        
-                        elif current_screen == "MAIN_MENU":
-                            next_screen_id = user_data.get("selected_service")
-                            valid_screens = ["CREDIT_SCORE", "CREDIT_BANDWIDTH", "LOAN_CALCULATOR", "LOAN_TYPES", "SERVICES", "AFFORDABILITY_CHECK"]
-                            
-                            if next_screen_id in valid_screens:
-                                response_obj = {"screen": next_screen_id, "data": user_data}
-                            else:
-                                response_obj = {"screen": "MAIN_MENU", "data": {"error_message": "Chaguo batili."}}
-                        
-                        else:
-                            response_obj = {"screen": "MAIN_MENU", "data": {"error_message": "Kosa: Sehemu ya huduma haikupatikana."}}
-                            
-                    elif flow_id_key == "ACCOUNT_FLOW_ID_2":
-                        if current_screen == "PROFILE_UPDATE":
-                            response_obj = json.loads(json.dumps(current_flow_screens["SUMMARY"]))
-                            response_obj["data"].update(user_data)
-                        else:
-                            response_obj = FLOW_DEFINITIONS["ERROR"] 
-                        
-                    else:
-                        response_obj = FLOW_DEFINITIONS["ERROR"]
-
-                else:
-                    response_obj = {"screen": current_screen, "data": {"error_message": f"Action '{action}' not handled."}}
+                # Ping, success, INIT and data_exchange routing via the precompiled route tables
+                flow_handler = route_flow_action(flow_id_key, action)
+                response_obj = flow_handler(flow_id_key, action, current_screen, user_data, flow_token)
 
                 # --- Encrypt and return response (UNCHANGED) ---
                 if response_obj is not None:
-                    flipped_iv = bytes([b ^ 0xFF for b in iv]) 
-                    cipher_resp = AES.new(aes_key, AES.MODE_GCM, nonce=flipped_iv)
-                    response_json_string = json.dumps(response_obj)
-                    encrypted_resp_bytes, resp_tag = cipher_resp.encrypt_and_digest(response_json_string.encode("utf-8"))
-                    full_resp = encrypted_resp_bytes + resp_tag
-                    full_resp_b64 = base64.b64encode(full_resp).decode("utf-8")
+                    flipped_iv = flip_iv(iv)
+                    if isinstance(response_obj, bytes):
+                        # Pre-serialized template (flow success); report its screen from the definition
+                        response_json = response_obj
+                        next_screen_name = FLOW_DEFINITIONS[flow_id_key]["SUCCESS_RESPONSE"].get('screen', 'STATUS_CHECK')
+                    else:
+                        response_json = orjson.dumps(response_obj)
+                        next_screen_name = response_obj.get('screen', 'STATUS_CHECK')
+                    full_resp = aead.encrypt(flipped_iv, response_json, None)
+                    full_resp_b64 = _b64encode(full_resp, newline=False)
                     
-                    next_screen_name = response_obj.get('screen', 'STATUS_CHECK')
-                    logger.critical(f"✅ Encrypted flow response generated. Next Screen: {next_screen_name}")
-                    return PlainTextResponse(full_resp_b64)
+                    logger.critical("✅ Encrypted flow response generated. Next Screen: %s", next_screen_name)
+                    # base64 is already ASCII bytes: hand them to Response as-is, no str round trip
+                    return Response(content=full_resp_b64, media_type="text/plain")
                 
                 return PlainTextResponse("Flow action processed, but no response object generated.", status_code=200)
 
             except Exception as e:
-                if "Incorrect decryption" in str(e):
-                    logger.critical("🚨 Decryption Failure (Incorrect decryption.): Key mismatch.")
+                if "Decryption failed" in str(e):
+                    logger.critical("🚨 Decryption Failure (RSA-OAEP unwrap failed): Key mismatch.")
+                elif isinstance(e, InvalidTag):
+                    logger.critical("🚨 Decryption Failure (GCM tag mismatch): Payload or AES key invalid.")
                 else:
-                    logger.critical(f"General Flow Processing/Security Error: {e}", exc_info=True)
+                    logger.critical("General Flow Processing/Security Error: %s", e, exc_info=True)
                 
                 return PlainTextResponse("Failed to process flow payload due to internal error.", status_code=500)
 
@@ -295,64 +717,20 @@ async def whatsapp_webhook(request: Request, background_tasks: BackgroundTasks):
                  logger.error("❌ Could not determine 'from_number' for regular message.")
                  return PlainTextResponse("OK (No Sender)", status_code=200)
 
-            # Handle TEXT messages (MODIFIED: Pass full message payload as dict)
-            if message_type == "text":
-                # Create the simplified payload dictionary
-                text_payload = {
-                    "from_number": from_number,
-                    "user_name": user_name,
-                    "body": message.get("text", {}).get("body", "") # The message text
-                }
-                
-                logger.critical(f"💬 Message from {from_number} ({user_name}): {text_payload['body']}")
-                
-                # --- START OF FIX: Reroute to whatsapp_menu with the text payload dict ---
-                background_tasks.add_task(
-                    whatsapp_menu,
-                    text_payload # Pass the dictionary as the *first* argument (or ensure function accepts a dict)
-                )
-                logger.critical(f"✅ Text message '{text_payload['body']}' routed to whatsapp_menu for {from_number}.")
-                # --- END OF FIX ---
-            
-            # Handle MEDIA messages (unchanged)
-            elif message_type in ["image", "document", "video", "audio"]:
-                media_object = message.get(message_type, {})
-                media_id = media_object.get("id")
-                mime_type = media_object.get("mime_type")
-                file_name = media_object.get("filename", f"file.{mime_type.split('/')[-1] if '/' in mime_type else 'dat'}")
-
-                if media_id:
-                    logger.critical(f"📎 Media message detected: {message_type}, ID: {media_id}")
-                    try:
-                        media_url = get_media_url(media_id)
-                        await send_meta_whatsapp_message(from_number, "✅ Tumepokea faili lako. Tafadhali subiri uchambuzi wa kwanza...")
-                        
-                        background_tasks.add_task(
-                                process_file_upload,
-                                user_id=from_number,
-                                user_name=user_name,
-                                user_phone=from_number,
-                                flow_type="REGULAR_MEDIA",
-                                media_url=media_url,
-                                mime_type=mime_type,
-                               file_name=file_name
-                        )
-                        logger.critical(f"✅ Media processing task queued for {from_number}")
-
-                    except Exception as e:
-                        logger.error(f"❌ Error handling media ID {media_id}: {e}", exc_info=True)
-                        await send_meta_whatsapp_message(from_number, "Samahani, kuna hitilafu imetokea wakati tukipakia faili lako.")
-
-            
-            # Handle INTERACTIVE messages (unchanged)
-            elif message_type == "interactive":
-                logger.critical(f"💬 Received Interactive message from {from_number}")
-                
-            else:
-                logger.critical(f"Received unhandled message type: {message_type} from {from_number}")
+            message_handler = MESSAGE_HANDLERS.get(message_type, handle_unhandled_message)
+            await message_handler(request, message, message_type, from_number, user_name)
                 
-        return PlainTextResponse("OK")
+        return OK_RESPONSE
 
     except Exception as e:
-        logger.critical(f"Webhook Error: {e}", exc_info=True)
-        return PlainTextResponse("Internal Server Error", status_code=500)
\ No newline at end of file
+        logger.critical("Webhook Error: %s", e, exc_info=True)
+        return PlainTextResponse("Internal Server Error", status_code=500)
+
+if __name__ == "__main__":
+    # Local entry point mirroring the procfile: uvloop event loop + httptools parser,
+    # with idle connections kept open long enough for Meta's back-to-back webhook posts
+    import uvicorn
+    uvicorn.run(
+        app, host="0.0.0.0", port=int(os.getenv("PORT", "8000")),
+        loop="uvloop", http="httptools", timeout_keep_alive=30,
+    )
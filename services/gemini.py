@@ -48,7 +48,7 @@ def analyze_image(image_bytes: bytes, mime_type: str) -> str:
     except APIError:
         return " Hitilafu ya API ya Gemini."
     except Exception as e:
-        logger.error(f"General Error analyzing image: {e}", exc_info=True)
+        logger.error("General Error analyzing image: %s", e, exc_info=True)
         return " Hitilafu ya Jumla katika kuchambua picha."
 
 
@@ -87,8 +87,8 @@ def analyze_file_with_gemini(file_data: bytes, filename: str) -> str:
         return result_text
 
     except APIError as e:
-        logger.error(f"Gemini API Error: {e}", exc_info=True)
+        logger.error("Gemini API Error: %s", e, exc_info=True)
         return " Hitilafu ya API ya Gemini: Udadisi wa nyaraka umeshindwa."
     except Exception as e:
-        logger.exception(f"General Error during Gemini PDF analysis: {e}")
+        logger.exception("General Error during Gemini PDF analysis: %s", e)
         return f" Hitilafu ya Jumla katika kuchambua faili '{filename}'. Tafadhali jaribu tena."
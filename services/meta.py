@@ -1,7 +1,7 @@
 import os
 import uuid 
 import logging
-import requests
+import httpx
 from typing import Dict, Any, Optional, List
 from dotenv import load_dotenv 
 
@@ -25,7 +25,27 @@ API_VERSION = "v21.0"
 API_URL = f"https://graph.facebook.com/{API_VERSION}/{PHONE_NUMBER_ID}/messages"
 MEDIA_API_BASE_URL = f"https://graph.facebook.com/{API_VERSION}/"
 
-logger.info(f"*** DEBUG: Using PHONE_NUMBER_ID: {PHONE_NUMBER_ID} for API_URL: {API_URL}")
+logger.info("*** DEBUG: Using PHONE_NUMBER_ID: %s for API_URL: %s", PHONE_NUMBER_ID, API_URL)
+
+# -----------------------------------
+# SHARED HTTP CLIENT
+# -----------------------------------
+# One pooled HTTP/2 client for all Meta Graph API calls, so TCP+TLS connections are
+# reused across messages instead of being set up again for every request.
+# Redirects are followed like requests did, so redirected media URLs still download.
+HTTP_CLIENT = httpx.AsyncClient(
+    http2=True,
+    follow_redirects=True,
+    timeout=10.0,
+    limits=httpx.Limits(max_keepalive_connections=50),
+)
+
+
+async def close_http_client() -> None:
+    """
+    Close the shared Meta HTTP client (call on application shutdown).
+    """
+    await HTTP_CLIENT.aclose()
 
 # ==============================================================
 # SEND SIMPLE WHATSAPP TEXT MESSAGE (UNCHANGED)
@@ -50,18 +70,18 @@ async def send_meta_whatsapp_message(to: str, body: str) -> Dict[str, Any]:
     }
 
     try:
-        response = requests.post(API_URL, json=payload, headers=headers)
+        response = await HTTP_CLIENT.post(API_URL, json=payload, headers=headers)
         response.raise_for_status()
-        logger.info(f"✅ Text message sent to {to}.")
+        logger.info("✅ Text message sent to %s.", to)
         return response.json()
-    except requests.exceptions.RequestException as e:
-        logger.error(f"❌ Error sending message to {to}: {e}")
+    except (httpx.HTTPError, ValueError) as e:  # ValueError: non-JSON response body
+        logger.error("❌ Error sending message to %s: %s", to, e)
         raise RuntimeError(f"Meta API call failed: {e}")
 
 # ==============================================================
 # SEND WHATSAPP TEMPLATE MESSAGE WITH FLOW BUTTON (UNCHANGED)
 # ==============================================================
-def send_meta_whatsapp_template(
+async def send_meta_whatsapp_template(
     to: str,
     template_name: str,
     language_code: str = "en",
@@ -96,21 +116,21 @@ def send_meta_whatsapp_template(
         payload["template"]["components"] = components
 
     try:
-        logger.info(f"🚀 Sending Template '{template_name}' to {to}")
+        logger.info("🚀 Sending Template '%s' to %s", template_name, to)
         
-        response = requests.post(API_URL, json=payload, headers=headers)
+        response = await HTTP_CLIENT.post(API_URL, json=payload, headers=headers)
         response.raise_for_status()
         
-        logger.info(f"✅ Template sent successfully.")
+        logger.info("✅ Template sent successfully.")
         return response.json()
         
-    except requests.exceptions.HTTPError as e:
-        logger.error(f"❌ HTTP Error sending template to {to}: {e}")
-        logger.error(f"Response: {e.response.text if e.response else 'No response'}")
+    except httpx.HTTPStatusError as e:
+        logger.error("❌ HTTP Error sending template to %s: %s", to, e)
+        logger.error("Response: %s", e.response.text)
         raise RuntimeError(f"Meta Template API HTTP error: {e}")
         
-    except requests.exceptions.RequestException as e:
-        logger.error(f"❌ Template send error for {to}: {e}")
+    except (httpx.HTTPError, ValueError) as e:  # ValueError: non-JSON response body
+        logger.error("❌ Template send error for %s: %s", to, e)
         raise RuntimeError(f"Meta Template API call failed: {e}")
 
 # ==============================================================
@@ -122,7 +142,7 @@ async def send_manka_menu_template(to: str, flow_token: Optional[str] = None) ->
     """
     final_flow_token = flow_token if flow_token else "unused"
 
-    logger.critical(f"🔑 Embedding flow_token into template: {final_flow_token}")
+    logger.critical("🔑 Embedding flow_token into template: %s", final_flow_token)
 
     components = [
         {
@@ -143,7 +163,7 @@ async def send_manka_menu_template(to: str, flow_token: Optional[str] = None) ->
         }
     ]
     
-    return send_meta_whatsapp_template(
+    return await send_meta_whatsapp_template(
         to=to,
         template_name="manka_menu_03",
         language_code="en",
@@ -186,19 +206,19 @@ async def send_quick_reply_message(to: str, body: str, buttons: List[Dict[str, A
     }
 
     try:
-        logger.info(f"💬 Sending Quick Reply message to {to}.")
-        response = requests.post(API_URL, json=payload, headers=headers)
+        logger.info("💬 Sending Quick Reply message to %s.", to)
+        response = await HTTP_CLIENT.post(API_URL, json=payload, headers=headers)
         response.raise_for_status()
-        logger.info(f"✅ Quick Reply sent successfully to {to}.")
+        logger.info("✅ Quick Reply sent successfully to %s.", to)
         return response.json()
-    except requests.exceptions.RequestException as e:
-        logger.error(f"❌ Error sending Quick Reply to {to}: {e}", exc_info=True)
+    except (httpx.HTTPError, ValueError) as e:  # ValueError: non-JSON response body
+        logger.error("❌ Error sending Quick Reply to %s: %s", to, e, exc_info=True)
         raise RuntimeError(f"Meta Quick Reply API call failed: {e}")
 
 # ==============================================================
 # GET MEDIA DOWNLOAD URL (UNCHANGED)
 # ==============================================================
-def get_media_url(media_id: str) -> str:
+async def get_media_url(media_id: str) -> str:
     """
     Get the download URL for a media file from WhatsApp.
     """
@@ -209,8 +229,8 @@ def get_media_url(media_id: str) -> str:
     headers = {"Authorization": f"Bearer {ACCESS_TOKEN}"}
 
     try:
-        logger.info(f"📥 Fetching media URL for ID {media_id}")
-        response = requests.get(url, headers=headers)
+        logger.info("📥 Fetching media URL for ID %s", media_id)
+        response = await HTTP_CLIENT.get(url, headers=headers)
         response.raise_for_status()
         data = response.json()
 
@@ -220,6 +240,6 @@ def get_media_url(media_id: str) -> str:
 
         logger.info("✅ Media URL retrieved successfully")
         return download_url
-    except requests.exceptions.RequestException as e:
-        logger.error(f"❌ Media URL lookup failed: {e}")
+    except (httpx.HTTPError, ValueError) as e:  # ValueError: non-JSON response body
+        logger.error("❌ Media URL lookup failed: %s", e)
         raise RuntimeError(f"Media URL lookup failed: {e}")
\ No newline at end of file
@@ -32,7 +32,7 @@ def analyze_pdf(file_data: bytes, filename: str, user_fullname: str) -> str:
         )
 
         if not response.ok:
-            logger.error(f"MANKA FAILED (HTTP {response.status_code}): {response.text[:100]}")
+            logger.error("MANKA FAILED (HTTP %s): %s", response.status_code, response.text[:100])
             return (
                 "Uchambuzi wa kwanza umefaulu, tafadhali subiri uchambuzi wa pili."
                 "\n\n" + analyze_file_with_gemini(file_data, filename)
@@ -72,7 +72,7 @@ def analyze_pdf(file_data: bytes, filename: str, user_fullname: str) -> str:
             )
 
         else:
-            logger.error(f"Unexpected data type from Manka: {type(affordability_data)}")
+            logger.error("Unexpected data type from Manka: %s", type(affordability_data))
             return (
                 "Uchambuzi wa kwanza umefaulu, tafadhali subiri uchambuzi wa pili."
                 "\n\n" + analyze_file_with_gemini(file_data, filename)
@@ -86,14 +86,14 @@ def analyze_pdf(file_data: bytes, filename: str, user_fullname: str) -> str:
         )
 
     except EnvironmentError as e:
-        logger.error(f"Manka Config Error: {e}")
+        logger.error("Manka Config Error: %s", e)
         return (
             "Uchambuzi wa kwanza umefaulu, tafadhali subiri uchambuzi wa pili."
             "\n\n" + analyze_file_with_gemini(file_data, filename)
         )
 
     except Exception as e:
-        logger.exception(f"General Error analyzing PDF with Manka: {e}")
+        logger.exception("General Error analyzing PDF with Manka: %s", e)
         return (
             "Uchambuzi wa kwanza umefaulu, tafadhali subiri uchambuzi wa pili."
             "\n\n" + analyze_file_with_gemini(file_data, filename)
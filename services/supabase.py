@@ -1,5 +1,6 @@
 import os
 import uuid
+import asyncio
 import logging
 from supabase import create_client, Client
 from typing import Optional
@@ -50,17 +51,19 @@ async def store_session_data(
     }
 
     try:
-        response = supabase.table("whatsapp_sessions").insert(session_record).execute()
+        # The supabase client is synchronous; keep its HTTP round trip off the event loop
+        query = supabase.table("whatsapp_sessions").insert(session_record)
+        response = await asyncio.to_thread(query.execute)
 
         if getattr(response, "data", None):
-            logger.info(f"✅ Session stored for {phone_number} (ID: {final_session_id})")
+            logger.info("✅ Session stored for %s (ID: %s)", phone_number, final_session_id)
             return final_session_id
 
         logger.error("❌ Supabase insert returned no data.")
         return None
 
     except Exception as e:
-        logger.error(f"❌ Failed to store session: {e}")
+        logger.error("❌ Failed to store session: %s", e)
         return None
 
 
@@ -69,23 +72,23 @@ async def get_session_phone_by_id(session_id: str) -> Optional[str]:
     Retrieves the phone number tied to a session_id (UUID/Flow Token).
     """
     try:
-        response = (
+        query = (
             supabase.table("whatsapp_sessions")
             .select("phone_number")
             .eq("session_id", session_id)
             .single()
-            .execute()
         )
+        response = await asyncio.to_thread(query.execute)
 
         if getattr(response, "data", None):
             phone = response.data.get("phone_number")
-            logger.info(f"📲 Retrieved phone ({phone}) for session: {session_id}")
+            logger.info("📲 Retrieved phone (%s) for session: %s", phone, session_id)
             return phone
 
         return None
 
     except Exception as e:
-        logger.error(f"❌ Error retrieving phone by session ID: {e}")
+        logger.error("❌ Error retrieving phone by session ID: %s", e)
         return None
 
 
@@ -138,9 +141,9 @@ def store_file(
 
         supabase.table("wHatsappUsers").insert(metadata).execute()
 
-        logger.info(f"✅ File stored successfully: {supabase_path}")
+        logger.info("✅ File stored successfully: %s", supabase_path)
         return {"file_url": public_url, "file_type": mime_type}
 
     except Exception as e:
-        logger.exception(f"❌ File storage failed for {user_phone}: {e}")
+        logger.exception("❌ File storage failed for %s: %s", user_phone, e)
         return None
\ No newline at end of file